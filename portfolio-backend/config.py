@@ -11,17 +11,39 @@ class Config:
     DB_PASSWORD = os.getenv('DB_PASSWORD')
     DB_NAME = os.getenv('DB_NAME')
     
+    # Connection pool configuration
+    DB_POOL_MIN_SIZE = 2
+    DB_POOL_MAX_SIZE = 10
+    DB_COMMAND_TIMEOUT = 30  # seconds per statement
+    DB_BULK_TIMEOUT = 6 * 3600  # seconds, switching price_history (UN)LOGGED rewrites the whole table
+    
     # Supabase configuration
    # SUPABASE_URL = os.getenv('SUPABASE_URL')
    # SUPABASE_SERVICE_ROLE_KEY = os.getenv('SUPABASE_SERVICE_ROLE_KEY')
     
     # Yahoo Finance API configuration
     START_DATE = '2000-01-01'
-    RATE_LIMIT_DELAY = 1  # seconds between requests
+    CONCURRENCY = 8  # initial number of parallel Yahoo requests
+    MAX_CONCURRENCY = 32  # ceiling the request limit grows to while Yahoo keeps up
+    BACKOFF_FACTOR = 0.5  # request limit multiplier on HTTP 429
+    RETRY_AFTER_DEFAULT = 2  # seconds to back off on a 429 without Retry-After
+    RATE_LIMIT_MIN_REMAINING = 5  # wait for the window reset below this many requests left
+    FETCH_BATCH_SIZE = 50  # symbols fetched together and written with one COPY
+    BACKFILL_BATCH_SIZE = 10  # smaller batches for full-history fetches, which are large
+    BATCHES_IN_FLIGHT = 4  # batches being fetched at the same time
+    QUEUE_SIZE = 4  # fetched batches waiting to be written
+    DB_WRITERS = 2  # concurrent database writers
+    HTTP_TIMEOUT = 60  # seconds per request
+    HTTP_MAX_KEEPALIVE = 32  # idle connections kept open
     
     # Data processing configuration
-    BATCH_SIZE = 1000  # number of records to process in batches
-    MAX_RETRIES = 3    # maximum retry attempts for failed requests
+    SYMBOL_CACHE_TTL = 300  # seconds symbol mappings are reused before re-querying, in-process only
+    MAX_RETRIES = 8    # maximum attempts for failed requests, with exponential back-off
+    RETRY_MAX_WAIT = 60  # seconds, cap of the back-off between attempts
+    
+    # Scheduler configuration (scheduler.py --daemon)
+    SCHEDULE_CRON = os.getenv('SCHEDULE_CRON', '0 22 * * *')  # crontab expression for the daily update
+    SCHEDULE_MISFIRE_GRACE = 3600  # seconds a missed run may still start late
     
     # Logging configuration
     LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
@@ -0,0 +1,97 @@
+import logging
+from typing import Dict, List, Tuple
+import asyncpg
+import pandas as pd
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Pools created through create_pool(), closed together by close_all_pools()
+_pools: List[asyncpg.Pool] = []
+
+# Column order of the records passed to copy_upsert_prices()
+PRICE_COLUMNS = ['yahoo_symbol', 'date', 'open_price', 'high_price', 'low_price', 'close_price', 'volume']
+
+async def create_pool(db_config: Dict) -> asyncpg.Pool:
+    """Create a connection pool shared by every query of a run"""
+    try:
+        pool = await asyncpg.create_pool(
+            **db_config,
+            min_size=Config.DB_POOL_MIN_SIZE,
+            max_size=Config.DB_POOL_MAX_SIZE,
+            command_timeout=Config.DB_COMMAND_TIMEOUT
+        )
+    except Exception as e:
+        logger.error(f"Failed to connect to database: {e}")
+        raise
+    
+    _pools.append(pool)
+    return pool
+
+async def close_all_pools():
+    """Close every pool created through create_pool()"""
+    while _pools:
+        pool = _pools.pop()
+        await pool.close()
+
+# Staging table of copy_upsert_prices(), created inside each transaction: behind a
+# transaction-mode pooler (Supabase's port 6543) a session-level temp table may
+# not exist on the backend that runs the next transaction
+STAGING_TABLE_QUERY = """
+    CREATE TEMP TABLE tmp_prices (
+        yahoo_symbol VARCHAR(50),
+        date DATE,
+        open_price DECIMAL(10,4),
+        high_price DECIMAL(10,4),
+        low_price DECIMAL(10,4),
+        close_price DECIMAL(10,4),
+        volume BIGINT
+    ) ON COMMIT DROP
+"""
+
+# Merge of the staged rows into price_history, DISTINCT ON guards against a
+# duplicated bar, which ON CONFLICT can't update twice
+MERGE_QUERY = """
+    INSERT INTO price_history (yahoo_symbol, date, open_price, high_price, low_price, close_price, volume)
+    SELECT DISTINCT ON (yahoo_symbol, date)
+        yahoo_symbol, date, open_price, high_price, low_price, close_price, volume
+    FROM tmp_prices
+    ORDER BY yahoo_symbol, date
+    ON CONFLICT (yahoo_symbol, date) {on_conflict}
+"""
+
+# Conflict actions of the merge in copy_upsert_prices()
+ON_CONFLICT_UPDATE = """
+    DO UPDATE SET
+        open_price = EXCLUDED.open_price,
+        high_price = EXCLUDED.high_price,
+        low_price = EXCLUDED.low_price,
+        close_price = EXCLUDED.close_price,
+        volume = EXCLUDED.volume,
+        updated_at = CURRENT_TIMESTAMP
+"""
+ON_CONFLICT_IGNORE = "DO NOTHING"
+
+def frame_to_records(price_data: pd.DataFrame) -> List[Tuple]:
+    """Convert a price DataFrame to records in PRICE_COLUMNS order, with NaN as None"""
+    # Nullable Int64 turns float volume (float when it has gaps) into the ints BIGINT needs
+    columns = price_data[PRICE_COLUMNS].astype({'volume': 'Int64'})
+    
+    # One mask over the whole frame, object dtype lets None stand in for missing values
+    values = columns.astype(object).where(columns.notna(), None)
+    return list(values.itertuples(index=False, name=None))
+
+async def copy_upsert_prices(conn: asyncpg.Connection, records: List[Tuple], update_existing: bool = True) -> int:
+    """Upsert price records by COPYing them into a transaction-scoped staging table and merging
+    them with one INSERT ... SELECT, returning the number of rows written. With
+    update_existing=False rows already stored are left alone, which skips their index
+    and WAL writes."""
+    on_conflict = ON_CONFLICT_UPDATE if update_existing else ON_CONFLICT_IGNORE
+    
+    async with conn.transaction():
+        await conn.execute(STAGING_TABLE_QUERY)
+        await conn.copy_records_to_table('tmp_prices', records=records, columns=PRICE_COLUMNS)
+        status = await conn.execute(MERGE_QUERY.format(on_conflict=on_conflict))
+    
+    # Command status has the form 'INSERT 0 <rows>'
+    return int(status.split()[-1])
@@ -1,63 +1,57 @@
 import os
 import asyncio
 import logging
-from datetime import datetime, timedelta
-from typing import List, Dict, Optional
+from datetime import date
+from typing import List, Dict, Optional, Tuple
 import pandas as pd
-import yfinance as yf
 from dotenv import load_dotenv
 import asyncpg
 import json
+from config import Config
+from db import create_pool, close_all_pools, copy_upsert_prices, frame_to_records
+from logging_setup import setup_logging
+from pipeline import run_pipeline, chunked, gather_batch
+from yahoo_client import YahooChartClient
 
 # Load environment variables
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('historical_prices.log'),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
 class HistoricalPricesFetcher:
-    def __init__(self):
+    def __init__(self, bulk_mode: bool = False):
         #self.supabase_url = os.getenv('SUPABASE_URL')
         #self.supabase_key = os.getenv('SUPABASE_SERVICE_ROLE_KEY')
         self.db_config = {
-            'host': os.getenv('DB_HOST', 'localhost'),
-            'port': int(os.getenv('DB_PORT', '6543'),
-            'user': os.getenv('DB_USER'),
-            'password': os.getenv('DB_PASSWORD'),
-            'database': os.getenv('DB_NAME')
+            'host': Config.DB_HOST,
+            'port': Config.DB_PORT,
+            'user': Config.DB_USER,
+            'password': Config.DB_PASSWORD,
+            'database': Config.DB_NAME
         }
-        self.start_date = '2000-01-01'
-        self.end_date = datetime.now().strftime('%Y-%m-%d')
+        self.start_date = date.fromisoformat(Config.START_DATE)
+        self.end_date = date.today()
+        self.pool: Optional[asyncpg.Pool] = None
+        self.yahoo = YahooChartClient()
+        # Load into an unlogged table, skipping WAL for the backfill
+        self.bulk_mode = bulk_mode
         
-    async def get_db_connection(self):
-        """Create database connection"""
-        try:
-            conn = await asyncpg.connect(**self.db_config)
-            return conn
-        except Exception as e:
-            logger.error(f"Failed to connect to database: {e}")
-            raise
+    async def init_pool(self):
+        """Create the database connection pool if it doesn't exist yet"""
+        if self.pool is None:
+            self.pool = await create_pool(self.db_config)
     
     async def get_symbol_mappings(self) -> List[Dict]:
         """Fetch all active symbol mappings from database"""
         try:
-            conn = await self.get_db_connection()
             query = """
                 SELECT id, ibkr_symbol, yahoo_symbol, security_name, exchange, asset_type
                 FROM symbol_mappings 
                 WHERE is_active = true
                 ORDER BY id
             """
-            rows = await conn.fetch(query)
-            await conn.close()
+            async with self.pool.acquire() as conn:
+                rows = await conn.fetch(query)
             
             symbols = []
             for row in rows:
@@ -77,57 +71,28 @@ class HistoricalPricesFetcher:
             logger.error(f"Error fetching symbol mappings: {e}")
             raise
     
-    def fetch_yahoo_historical_data(self, symbol: str) -> Optional[pd.DataFrame]:
+    async def fetch_yahoo_historical_data(self, symbol: str) -> Optional[pd.DataFrame]:
         """Fetch historical data from Yahoo Finance for a given symbol"""
         try:
-            logger.info(f"Fetching data for {symbol}")
+            logger.debug(f"Fetching data for {symbol}")
             
-            # Create ticker object
-            ticker = yf.Ticker(symbol)
+            hist_data = await self.yahoo.fetch_history(symbol, self.start_date, self.end_date)
             
-            # Fetch historical data
-            hist_data = ticker.history(
-                start=self.start_date,
-                end=self.end_date,
-                interval='1d',
-                auto_adjust=True
-            )
-            
-            if hist_data.empty:
+            if hist_data is None:
                 logger.warning(f"No data found for symbol: {symbol}")
                 return None
             
-            # Reset index to make date a column
-            hist_data = hist_data.reset_index()
-            
-            # Rename columns to match our database schema
-            hist_data = hist_data.rename(columns={
-                'Date': 'date',
-                'Open': 'open_price',
-                'High': 'high_price',
-                'Low': 'low_price',
-                'Close': 'close_price',
-                'Volume': 'volume'
-            })
-            
-            # Convert date to string format
-            hist_data['date'] = hist_data['date'].dt.strftime('%Y-%m-%d')
-            
-            # Add symbol information
-            hist_data['yahoo_symbol'] = symbol
-            
-            logger.info(f"Successfully fetched {len(hist_data)} records for {symbol}")
+            logger.debug(f"Successfully fetched {len(hist_data)} records for {symbol}")
             return hist_data
             
         except Exception as e:
+            # Failed even after retries, let the caller count the symbol as failed
             logger.error(f"Error fetching data for {symbol}: {e}")
-            return None
+            raise
     
     async def create_price_history_table(self):
         """Create the price_history table if it doesn't exist"""
         try:
-            conn = await self.get_db_connection()
-            
             create_table_query = """
                 CREATE TABLE IF NOT EXISTS price_history (
                     id SERIAL PRIMARY KEY,
@@ -143,87 +108,76 @@ class HistoricalPricesFetcher:
                     UNIQUE(yahoo_symbol, date)
                 );
                 
-                -- Create indexes for better performance
-                CREATE INDEX IF NOT EXISTS idx_price_history_symbol ON price_history(yahoo_symbol);
-                CREATE INDEX IF NOT EXISTS idx_price_history_date ON price_history(date);
-                CREATE INDEX IF NOT EXISTS idx_price_history_symbol_date ON price_history(yahoo_symbol, date);
+                -- The UNIQUE(yahoo_symbol, date) index serves lookups by symbol and by symbol and date,
+                -- drop the extra indexes older versions created so writes don't have to maintain them
+                DROP INDEX IF EXISTS idx_price_history_symbol;
+                DROP INDEX IF EXISTS idx_price_history_date;
+                DROP INDEX IF EXISTS idx_price_history_symbol_date;
             """
             
-            await conn.execute(create_table_query)
-            await conn.close()
+            async with self.pool.acquire() as conn:
+                await conn.execute(create_table_query)
             logger.info("Price history table created/verified successfully")
             
         except Exception as e:
             logger.error(f"Error creating price history table: {e}")
             raise
     
-    async def store_price_data(self, symbol: str, price_data: pd.DataFrame):
-        """Store price data in the database"""
+    async def store_price_data(self, symbols: List[str], records: List[Tuple]) -> int:
+        """Store the price records of a batch of symbols in the database"""
         try:
-            conn = await self.get_db_connection()
-            
-            # Prepare data for insertion
-            records = []
-            for _, row in price_data.iterrows():
-                records.append((
-                    symbol,
-                    row['date'],
-                    float(row['open_price']) if pd.notna(row['open_price']) else None,
-                    float(row['high_price']) if pd.notna(row['high_price']) else None,
-                    float(row['low_price']) if pd.notna(row['low_price']) else None,
-                    float(row['close_price']) if pd.notna(row['close_price']) else None,
-                    int(row['volume']) if pd.notna(row['volume']) else None
-                ))
-            
             # Use upsert to handle duplicates
-            insert_query = """
-                INSERT INTO price_history (yahoo_symbol, date, open_price, high_price, low_price, close_price, volume)
-                VALUES ($1, $2, $3, $4, $5, $6, $7)
-                ON CONFLICT (yahoo_symbol, date) 
-                DO UPDATE SET
-                    open_price = EXCLUDED.open_price,
-                    high_price = EXCLUDED.high_price,
-                    low_price = EXCLUDED.low_price,
-                    close_price = EXCLUDED.close_price,
-                    volume = EXCLUDED.volume,
-                    updated_at = CURRENT_TIMESTAMP
-            """
+            async with self.pool.acquire() as conn:
+                written = await copy_upsert_prices(conn, records)
             
-            await conn.executemany(insert_query, records)
-            await conn.close()
-            
-            logger.info(f"Successfully stored {len(records)} price records for {symbol}")
+            logger.info(f"Successfully stored {written} price records for {len(symbols)} symbols")
+            return written
             
         except Exception as e:
-            logger.error(f"Error storing price data for {symbol}: {e}")
+            logger.error(f"Error storing price data for {', '.join(symbols)}: {e}")
             raise
     
-    async def process_symbol(self, symbol_mapping: Dict):
-        """Process a single symbol mapping"""
+    async def set_table_logged(self, logged: bool):
+        """Switch price_history between a logged and an unlogged table"""
+        # Both directions rewrite the table under an exclusive lock, far beyond DB_COMMAND_TIMEOUT on a full history
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("SET LOCAL statement_timeout = 0")
+                await conn.execute(
+                    f"ALTER TABLE price_history SET {'LOGGED' if logged else 'UNLOGGED'}",
+                    timeout=Config.DB_BULK_TIMEOUT
+                )
+        logger.info(f"price_history is now {'logged' if logged else 'unlogged'}")
+    
+    async def process_symbol(self, symbol_mapping: Dict) -> Optional[Tuple[str, List[Tuple]]]:
+        """Fetch a single symbol mapping and prepare its records for storage"""
         try:
             yahoo_symbol = symbol_mapping['yahoo_symbol']
             ibkr_symbol = symbol_mapping['ibkr_symbol']
             
-            logger.info(f"Processing {ibkr_symbol} -> {yahoo_symbol}")
+            logger.debug(f"Processing {ibkr_symbol} -> {yahoo_symbol}")
             
             # Fetch historical data
-            price_data = self.fetch_yahoo_historical_data(yahoo_symbol)
+            price_data = await self.fetch_yahoo_historical_data(yahoo_symbol)
             
             if price_data is not None:
-                # Store in database
-                await self.store_price_data(yahoo_symbol, price_data)
-                logger.info(f"Successfully processed {yahoo_symbol}")
+                # Prepare data for insertion
+                return yahoo_symbol, frame_to_records(price_data)
             else:
                 logger.warning(f"Skipping {yahoo_symbol} due to no data")
+                return None
                 
         except Exception as e:
             logger.error(f"Error processing symbol {symbol_mapping}: {e}")
+            raise
     
     async def run(self):
         """Main execution method"""
         try:
             logger.info("Starting historical price data fetch process")
             
+            await self.init_pool()
+            
             # Create table if it doesn't exist
             await self.create_price_history_table()
             
@@ -234,14 +188,37 @@ class HistoricalPricesFetcher:
                 logger.warning("No symbol mappings found")
                 return
             
-            # Process symbols with rate limiting to avoid API throttling
-            for i, symbol_mapping in enumerate(symbol_mappings):
-                await self.process_symbol(symbol_mapping)
-                
-                # Add delay between requests to avoid rate limiting
-                if i < len(symbol_mappings) - 1:
-                    await asyncio.sleep(1)
-            
+            if self.bulk_mode:
+                # An unlogged table is truncated after a crash, only load it this way when nothing else writes to it
+                await self.set_table_logged(False)
+            
+            async def consume(payload: Tuple[List[str], List[Tuple], List[Dict]]):
+                symbols, records, fetch_failed = payload
+                stored = await self.store_price_data(symbols, records) if records else 0
+                return stored, len(fetch_failed)
+            
+            try:
+                # Fetch batches of symbols concurrently while earlier batches are written to the database
+                results, failed = await run_pipeline(
+                    chunked(symbol_mappings, Config.BACKFILL_BATCH_SIZE),
+                    lambda batch: gather_batch(self.process_symbol, batch),
+                    consume
+                )
+            finally:
+                if self.bulk_mode:
+                    # Writes the whole table to WAL once, making it crash-safe again
+                    try:
+                        await self.set_table_logged(True)
+                    except Exception as e:
+                        logger.critical(
+                            f"Could not switch price_history back to LOGGED ({e}), it is still UNLOGGED and "
+                            f"will be emptied by a database crash. Run manually: ALTER TABLE price_history SET LOGGED;"
+                        )
+                        raise
+            
+            failed_symbols = sum(len(batch) for batch in failed) + sum(fetch_failed for _, fetch_failed in results)
+            stored = sum(stored for stored, _ in results)
+            logger.info(f"Stored {stored} records, {failed_symbols} symbols failed")
             logger.info("Historical price data fetch process completed successfully")
             
         except Exception as e:
@@ -249,9 +226,19 @@ class HistoricalPricesFetcher:
             raise
 
 async def main():
-    """Main function"""
-    fetcher = HistoricalPricesFetcher()
-    await fetcher.run()
+    """Main function, --bulk loads the backfill into an unlogged table"""
+    import sys
+    
+    fetcher = HistoricalPricesFetcher(bulk_mode='--bulk' in sys.argv)
+    try:
+        await fetcher.run()
+    finally:
+        await fetcher.yahoo.aclose()
+        await close_all_pools()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    listener = setup_logging()
+    try:
+        asyncio.run(main())
+    finally:
+        listener.stop()
@@ -1,28 +1,29 @@
 import os
 import asyncio
 import logging
-from datetime import datetime, timedelta
+import time
+from collections import defaultdict
+from datetime import date, timedelta
 from typing import List, Dict, Optional, Tuple
 import pandas as pd
-import yfinance as yf
 from dotenv import load_dotenv
 import asyncpg
 from config import Config
+from db import create_pool, close_all_pools, copy_upsert_prices, frame_to_records
+from logging_setup import setup_logging
+from pipeline import run_pipeline, chunked, gather_batch
+from yahoo_client import YahooChartClient
 
 # Load environment variables
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    level=getattr(logging, Config.LOG_LEVEL),
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(Config.LOG_FILE),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
+# Symbol mappings by query, with the monotonic time they were fetched at. Lives as long as the
+# process, so it only saves queries when updates run repeatedly in one process within the TTL
+# (scheduler.py --daemon with a SCHEDULE_CRON of SYMBOL_CACHE_TTL or less)
+_symbol_mappings_cache: Dict[str, Tuple[float, List[Dict]]] = {}
+
 class IncrementalPriceUpdater:
     def __init__(self):
         self.db_config = {
@@ -32,29 +33,32 @@ class IncrementalPriceUpdater:
             'password': Config.DB_PASSWORD,
             'database': Config.DB_NAME
         }
-        self.start_date = Config.START_DATE
+        self.start_date = date.fromisoformat(Config.START_DATE)
+        self.pool: Optional[asyncpg.Pool] = None
+        self.yahoo = YahooChartClient()
         
-    async def get_db_connection(self):
-        """Create database connection"""
-        try:
-            conn = await asyncpg.connect(**self.db_config)
-            return conn
-        except Exception as e:
-            logger.error(f"Failed to connect to database: {e}")
-            raise
+    async def init_pool(self):
+        """Create the database connection pool if it doesn't exist yet"""
+        if self.pool is None:
+            self.pool = await create_pool(self.db_config)
     
-    async def get_symbol_mappings(self) -> List[Dict]:
-        """Fetch all active symbol mappings from database"""
+    async def get_symbol_mappings(self, refresh: bool = False) -> List[Dict]:
+        """Fetch all active symbol mappings from database, cached for Config.SYMBOL_CACHE_TTL seconds"""
         try:
-            conn = await self.get_db_connection()
             query = """
                 SELECT id, ibkr_symbol, yahoo_symbol, security_name, exchange, asset_type
                 FROM symbol_mappings 
                 WHERE is_active = true
                 ORDER BY id
             """
-            rows = await conn.fetch(query)
-            await conn.close()
+            
+            cached = _symbol_mappings_cache.get(query)
+            if cached and not refresh and time.monotonic() - cached[0] < Config.SYMBOL_CACHE_TTL:
+                logger.info(f"Using {len(cached[1])} cached symbol mappings")
+                return cached[1]
+            
+            async with self.pool.acquire() as conn:
+                rows = await conn.fetch(query)
             
             symbols = []
             for row in rows:
@@ -67,6 +71,7 @@ class IncrementalPriceUpdater:
                     'asset_type': row['asset_type']
                 })
             
+            _symbol_mappings_cache[query] = (time.monotonic(), symbols)
             logger.info(f"Found {len(symbols)} active symbol mappings")
             return symbols
             
@@ -74,187 +79,147 @@ class IncrementalPriceUpdater:
             logger.error(f"Error fetching symbol mappings: {e}")
             raise
     
-    async def get_last_price_date(self, symbol: str) -> Optional[str]:
-        """Get the last date for which we have price data for a symbol"""
+    async def get_last_price_dates(self) -> Dict[str, date]:
+        """Get the last date for which we have price data, for every symbol in one query"""
         try:
-            conn = await self.get_db_connection()
             query = """
-                SELECT MAX(date) as last_date
+                SELECT yahoo_symbol, MAX(date) as last_date
                 FROM price_history 
-                WHERE yahoo_symbol = $1
+                GROUP BY yahoo_symbol
             """
-            row = await conn.fetchrow(query, symbol)
-            await conn.close()
+            async with self.pool.acquire() as conn:
+                rows = await conn.fetch(query)
             
-            if row and row['last_date']:
-                return row['last_date'].strftime('%Y-%m-%d')
-            return None
+            return {
+                row['yahoo_symbol']: row['last_date']
+                for row in rows
+                if row['last_date']
+            }
             
         except Exception as e:
-            logger.error(f"Error getting last price date for {symbol}: {e}")
-            return None
+            logger.error(f"Error getting last price dates: {e}")
+            raise
     
-    def fetch_yahoo_historical_data(self, symbol: str, start_date: str, end_date: str) -> Optional[pd.DataFrame]:
+    async def fetch_yahoo_historical_data(self, symbol: str, start_date: date, end_date: date) -> Optional[pd.DataFrame]:
         """Fetch historical data from Yahoo Finance for a given symbol and date range"""
         try:
-            logger.info(f"Fetching data for {symbol} from {start_date} to {end_date}")
-            
-            # Create ticker object
-            ticker = yf.Ticker(symbol)
+            logger.debug(f"Fetching data for {symbol} from {start_date} to {end_date}")
             
-            # Fetch historical data
-            hist_data = ticker.history(
-                start=start_date,
-                end=end_date,
-                interval='1d',
-                auto_adjust=True
-            )
+            hist_data = await self.yahoo.fetch_history(symbol, start_date, end_date)
             
-            if hist_data.empty:
+            if hist_data is None:
                 logger.warning(f"No data found for symbol: {symbol}")
                 return None
             
-            # Reset index to make date a column
-            hist_data = hist_data.reset_index()
-            
-            # Rename columns to match our database schema
-            hist_data = hist_data.rename(columns={
-                'Date': 'date',
-                'Open': 'open_price',
-                'High': 'high_price',
-                'Low': 'low_price',
-                'Close': 'close_price',
-                'Volume': 'volume'
-            })
-            
-            # Convert date to string format
-            hist_data['date'] = hist_data['date'].dt.strftime('%Y-%m-%d')
-            
-            # Add symbol information
-            hist_data['yahoo_symbol'] = symbol
-            
-            logger.info(f"Successfully fetched {len(hist_data)} records for {symbol}")
+            logger.debug(f"Successfully fetched {len(hist_data)} records for {symbol}")
             return hist_data
             
         except Exception as e:
+            # Failed even after retries, let the caller count the symbol as failed
             logger.error(f"Error fetching data for {symbol}: {e}")
-            return None
+            raise
     
-    async def store_price_data_batch(self, price_data: pd.DataFrame):
-        """Store price data in batches for better performance"""
+    async def store_price_data_batch(self, symbols: List[str], records: List[Tuple], update_existing: bool = True) -> Tuple[int, int]:
+        """Store the price records of a batch of symbols through a single COPY-based upsert,
+        returning the number of symbols and of records written"""
         try:
-            conn = await self.get_db_connection()
-            
-            # Prepare data for insertion
-            records = []
-            for _, row in price_data.iterrows():
-                records.append((
-                    row['yahoo_symbol'],
-                    row['date'],
-                    float(row['open_price']) if pd.notna(row['open_price']) else None,
-                    float(row['high_price']) if pd.notna(row['high_price']) else None,
-                    float(row['low_price']) if pd.notna(row['low_price']) else None,
-                    float(row['close_price']) if pd.notna(row['close_price']) else None,
-                    int(row['volume']) if pd.notna(row['volume']) else None
-                ))
-            
-            # Use upsert to handle duplicates
-            insert_query = """
-                INSERT INTO price_history (yahoo_symbol, date, open_price, high_price, low_price, close_price, volume)
-                VALUES ($1, $2, $3, $4, $5, $6, $7)
-                ON CONFLICT (yahoo_symbol, date) 
-                DO UPDATE SET
-                    open_price = EXCLUDED.open_price,
-                    high_price = EXCLUDED.high_price,
-                    low_price = EXCLUDED.low_price,
-                    close_price = EXCLUDED.close_price,
-                    volume = EXCLUDED.volume,
-                    updated_at = CURRENT_TIMESTAMP
-            """
-            
-            # Process in batches
-            batch_size = Config.BATCH_SIZE
-            for i in range(0, len(records), batch_size):
-                batch = records[i:i + batch_size]
-                await conn.executemany(insert_query, batch)
-                logger.info(f"Processed batch {i//batch_size + 1}/{(len(records)-1)//batch_size + 1}")
+            # Use upsert to handle duplicates, COPY streams all records in one go
+            async with self.pool.acquire() as conn:
+                written = await copy_upsert_prices(conn, records, update_existing)
             
-            await conn.close()
-            logger.info(f"Successfully stored {len(records)} price records")
+            logger.info(f"Successfully stored {written} of {len(records)} price records for {len(symbols)} symbols")
+            return len(symbols), written
             
         except Exception as e:
-            logger.error(f"Error storing price data: {e}")
+            logger.error(f"Error storing price data for {', '.join(symbols)}: {e}")
             raise
     
-    async def process_symbol_incremental(self, symbol_mapping: Dict) -> Tuple[bool, int]:
-        """Process a single symbol mapping with incremental updates"""
+    def get_start_date(self, last_date: Optional[date]) -> date:
+        """Get the first date to fetch for a symbol, given the last date we have data for"""
+        if last_date:
+            # Start from the next day after our last data
+            return last_date + timedelta(days=1)
+        # First time fetching data for this symbol
+        return self.start_date
+    
+    async def process_symbol_incremental(self, symbol_mapping: Dict, start_date: date, end_date: date) -> Optional[Tuple[str, List[Tuple]]]:
+        """Fetch new data for a single symbol mapping and prepare its records for storage"""
         try:
             yahoo_symbol = symbol_mapping['yahoo_symbol']
             ibkr_symbol = symbol_mapping['ibkr_symbol']
             
-            logger.info(f"Processing {ibkr_symbol} -> {yahoo_symbol}")
-            
-            # Get the last date we have data for
-            last_date = await self.get_last_price_date(yahoo_symbol)
-            
-            if last_date:
-                # Start from the next day after our last data
-                start_date = (datetime.strptime(last_date, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
-                logger.info(f"Updating {yahoo_symbol} from {start_date}")
-            else:
-                # First time fetching data for this symbol
-                start_date = self.start_date
-                logger.info(f"First time fetching data for {yahoo_symbol} from {start_date}")
-            
-            end_date = datetime.now().strftime('%Y-%m-%d')
-            
-            # Check if we need to fetch data
-            if start_date >= end_date:
-                logger.info(f"No new data needed for {yahoo_symbol}")
-                return True, 0
+            logger.debug(f"Processing {ibkr_symbol} -> {yahoo_symbol}")
             
             # Fetch new data
-            price_data = self.fetch_yahoo_historical_data(yahoo_symbol, start_date, end_date)
+            price_data = await self.fetch_yahoo_historical_data(yahoo_symbol, start_date, end_date)
             
             if price_data is not None and not price_data.empty:
-                # Store in database
-                await self.store_price_data_batch(price_data)
-                logger.info(f"Successfully processed {yahoo_symbol} with {len(price_data)} new records")
-                return True, len(price_data)
+                # Prepare data for insertion
+                return yahoo_symbol, frame_to_records(price_data)
             else:
                 logger.warning(f"No new data found for {yahoo_symbol}")
-                return True, 0
+                return None
                 
         except Exception as e:
             logger.error(f"Error processing symbol {symbol_mapping}: {e}")
-            return False, 0
+            raise
     
-    async def run_incremental_update(self):
-        """Run incremental update for all symbols"""
+    async def run_incremental_update(self, refresh: bool = False):
+        """Run incremental update for all symbols, refresh bypasses the symbol mappings cache"""
         try:
             logger.info("Starting incremental price data update process")
             
+            await self.init_pool()
+            
             # Get all symbol mappings
-            symbol_mappings = await self.get_symbol_mappings()
+            symbol_mappings = await self.get_symbol_mappings(refresh)
             
             if not symbol_mappings:
                 logger.warning("No symbol mappings found")
                 return
             
-            total_new_records = 0
-            successful_symbols = 0
-            
-            # Process symbols with rate limiting
-            for i, symbol_mapping in enumerate(symbol_mappings):
-                success, new_records = await self.process_symbol_incremental(symbol_mapping)
-                
-                if success:
-                    successful_symbols += 1
-                    total_new_records += new_records
-                
-                # Add delay between requests to avoid rate limiting
-                if i < len(symbol_mappings) - 1:
-                    await asyncio.sleep(Config.RATE_LIMIT_DELAY)
+            # Get the last date we have data for, for all symbols at once
+            last_dates = await self.get_last_price_dates()
+            end_date = date.today()
+            
+            # Bucket symbols by start date, in steady state nearly all of them share one
+            buckets: Dict[date, List[Dict]] = defaultdict(list)
+            for symbol_mapping in symbol_mappings:
+                start_date = self.get_start_date(last_dates.get(symbol_mapping['yahoo_symbol']))
+                # Check if we need to fetch data
+                if start_date < end_date:
+                    buckets[start_date].append(symbol_mapping)
+            
+            logger.info(f"{len(symbol_mappings) - sum(map(len, buckets.values()))} symbols already up to date")
+            
+            # Each batch shares the date range of its bucket; new symbols fetch full history in smaller batches
+            jobs = []
+            for start_date, bucket in sorted(buckets.items()):
+                logger.info(f"Updating {len(bucket)} symbols from {start_date}")
+                batch_size = Config.BACKFILL_BATCH_SIZE if start_date == self.start_date else Config.FETCH_BATCH_SIZE
+                jobs.extend((start_date, batch) for batch in chunked(bucket, batch_size))
+            
+            async def produce(job: Tuple[date, List[Dict]]):
+                start_date, batch = job
+                return await gather_batch(
+                    lambda symbol_mapping: self.process_symbol_incremental(symbol_mapping, start_date, end_date),
+                    batch
+                )
+            
+            async def consume(payload: Tuple[List[str], List[Tuple], List[Dict]]):
+                symbols, records, fetch_failed = payload
+                new_records = 0
+                if records:
+                    _, new_records = await self.store_price_data_batch(symbols, records)
+                return new_records, len(fetch_failed)
+            
+            # Fetch batches of symbols concurrently while earlier batches are written to the database
+            results, failed = await run_pipeline(jobs, produce, consume)
+            
+            # Symbols of batches that failed to store, and symbols that failed to fetch
+            failed_symbols = sum(len(batch) for _, batch in failed) + sum(fetch_failed for _, fetch_failed in results)
+            successful_symbols = len(symbol_mappings) - failed_symbols
+            total_new_records = sum(new_records for new_records, _ in results)
             
             logger.info(f"Incremental update completed. {successful_symbols}/{len(symbol_mappings)} symbols processed successfully.")
             logger.info(f"Total new records added: {total_new_records}")
@@ -263,51 +228,56 @@ class IncrementalPriceUpdater:
             logger.error(f"Error in incremental update execution: {e}")
             raise
     
-    async def run_daily_update(self):
-        """Run daily update for all symbols (typically run via cron job)"""
+    async def process_symbol_daily(self, symbol_mapping: Dict, start_date: date, end_date: date) -> Optional[Tuple]:
+        """Fetch the latest daily bar of a single symbol mapping as a ready-to-store record"""
+        try:
+            yahoo_symbol = symbol_mapping['yahoo_symbol']
+            ibkr_symbol = symbol_mapping['ibkr_symbol']
+            
+            logger.debug(f"Processing daily update for {ibkr_symbol} -> {yahoo_symbol}")
+            
+            # Fetch yesterday's bar straight from the chart JSON, a DataFrame is not worth it for one row
+            record = await self.yahoo.fetch_daily_row(yahoo_symbol, start_date, end_date)
+            
+            if record is None:
+                logger.warning(f"No daily data found for {yahoo_symbol}")
+            return record
+            
+        except Exception as e:
+            logger.error(f"Error processing daily update for {symbol_mapping}: {e}")
+            raise
+    
+    async def run_daily_update(self, refresh: bool = False):
+        """Run daily update for all symbols (typically run via cron job), refresh bypasses the symbol mappings cache"""
         try:
             logger.info("Starting daily price data update process")
             
+            await self.init_pool()
+            
             # Get all symbol mappings
-            symbol_mappings = await self.get_symbol_mappings()
+            symbol_mappings = await self.get_symbol_mappings(refresh)
             
             if not symbol_mappings:
                 logger.warning("No symbol mappings found")
                 return
             
             # For daily updates, we only need yesterday's data
-            yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
-            today = datetime.now().strftime('%Y-%m-%d')
-            
-            total_new_records = 0
-            successful_symbols = 0
-            
-            # Process symbols with rate limiting
-            for i, symbol_mapping in enumerate(symbol_mappings):
-                try:
-                    yahoo_symbol = symbol_mapping['yahoo_symbol']
-                    ibkr_symbol = symbol_mapping['ibkr_symbol']
-                    
-                    logger.info(f"Processing daily update for {ibkr_symbol} -> {yahoo_symbol}")
-                    
-                    # Fetch yesterday's data
-                    price_data = self.fetch_yahoo_historical_data(yahoo_symbol, yesterday, today)
-                    
-                    if price_data is not None and not price_data.empty:
-                        # Store in database
-                        await self.store_price_data_batch(price_data)
-                        total_new_records += len(price_data)
-                        successful_symbols += 1
-                        logger.info(f"Successfully updated {yahoo_symbol} with {len(price_data)} records")
-                    else:
-                        logger.warning(f"No daily data found for {yahoo_symbol}")
-                    
-                except Exception as e:
-                    logger.error(f"Error processing daily update for {symbol_mapping}: {e}")
-                
-                # Add delay between requests
-                if i < len(symbol_mappings) - 1:
-                    await asyncio.sleep(Config.RATE_LIMIT_DELAY)
+            today = date.today()
+            yesterday = today - timedelta(days=1)
+            
+            # One row per symbol, small enough to fetch everything and write it with a single COPY
+            outcomes = await asyncio.gather(
+                *(self.process_symbol_daily(mapping, yesterday, today) for mapping in symbol_mappings),
+                return_exceptions=True
+            )
+            records = [outcome for outcome in outcomes if outcome is not None and not isinstance(outcome, Exception)]
+            
+            successful_symbols = total_new_records = 0
+            if records:
+                # Rows already stored for yesterday are kept as they are
+                successful_symbols, total_new_records = await self.store_price_data_batch(
+                    [record[0] for record in records], records, update_existing=False
+                )
             
             logger.info(f"Daily update completed. {successful_symbols}/{len(symbol_mappings)} symbols processed successfully.")
             logger.info(f"Total new records added: {total_new_records}")
@@ -321,11 +291,20 @@ async def main():
     import sys
     
     updater = IncrementalPriceUpdater()
+    refresh = '--refresh' in sys.argv
     
-    if len(sys.argv) > 1 and sys.argv[1] == 'daily':
-        await updater.run_daily_update()
-    else:
-        await updater.run_incremental_update()
+    try:
+        if len(sys.argv) > 1 and sys.argv[1] == 'daily':
+            await updater.run_daily_update(refresh)
+        else:
+            await updater.run_incremental_update(refresh)
+    finally:
+        await updater.yahoo.aclose()
+        await close_all_pools()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    listener = setup_logging()
+    try:
+        asyncio.run(main())
+    finally:
+        listener.stop()
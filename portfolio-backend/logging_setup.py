@@ -0,0 +1,29 @@
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from config import Config
+
+def setup_logging() -> QueueListener:
+    """Configure root logging through a queue, so file and console writes happen on a
+    background thread instead of blocking the event loop. Stop the returned listener
+    on exit to flush pending records."""
+    log_queue = queue.Queue(-1)
+    
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    handlers = [
+        logging.FileHandler(Config.LOG_FILE),
+        logging.StreamHandler()
+    ]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    root = logging.getLogger()
+    root.setLevel(getattr(logging, Config.LOG_LEVEL))
+    root.addHandler(QueueHandler(log_queue))
+    
+    # httpx logs every request at INFO
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    
+    listener = QueueListener(log_queue, *handlers)
+    listener.start()
+    return listener
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Iterable, List, Optional, Tuple
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+async def run_pipeline(
+    items: Iterable,
+    produce: Callable[[Any], Awaitable[Optional[Any]]],
+    consume: Callable[[Any], Awaitable[Any]],
+    fetchers: int = Config.BATCHES_IN_FLIGHT,
+    writers: int = Config.DB_WRITERS,
+    queue_size: int = Config.QUEUE_SIZE
+) -> Tuple[List, List]:
+    """Run produce() over items and feed its results to consume() through a bounded queue,
+    so fetching the next items overlaps with writing the previous ones.
+
+    produce() returning None skips the item. Returns the consume() results and the
+    items whose produce() or consume() raised.
+    """
+    queue: asyncio.Queue = asyncio.Queue(queue_size)
+    sem = asyncio.Semaphore(fetchers)
+    results = []
+    failed = []
+
+    async def producer(item):
+        # Hold the fetch slot until the payload is queued, so slow writers stall fetching
+        # and at most fetchers + queue_size payloads are held in memory
+        async with sem:
+            try:
+                payload = await produce(item)
+            except Exception as e:
+                logger.error(f"Error producing pipeline item: {e}")
+                failed.append(item)
+                return
+            if payload is not None:
+                await queue.put((item, payload))
+
+    async def consumer():
+        while True:
+            item, payload = await queue.get()
+            try:
+                results.append(await consume(payload))
+            except Exception as e:
+                logger.error(f"Error consuming pipeline item: {e}")
+                failed.append(item)
+            finally:
+                queue.task_done()
+
+    consumers = [asyncio.create_task(consumer()) for _ in range(writers)]
+    try:
+        await asyncio.gather(*map(producer, items))
+        await queue.join()
+    finally:
+        for task in consumers:
+            task.cancel()
+        await asyncio.gather(*consumers, return_exceptions=True)
+
+    return results, failed
+
+def chunked(items: List, size: int) -> List[List]:
+    """Split items into consecutive lists of at most size elements"""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+async def gather_batch(
+    produce: Callable[[Any], Awaitable[Optional[Tuple[str, List[Tuple]]]]],
+    items: List
+) -> Optional[Tuple[List[str], List[Tuple], List]]:
+    """Run produce() concurrently over a batch of items and merge the (symbol, records)
+    payloads it returns, so the whole batch is written with a single COPY.
+
+    Items whose produce() raised are logged and returned as the failed items, next to
+    the symbols and records. Returns None when there is nothing to write or report.
+    """
+    outcomes = await asyncio.gather(*map(produce, items), return_exceptions=True)
+
+    symbols = []
+    records = []
+    failed = []
+    for item, outcome in zip(items, outcomes):
+        if isinstance(outcome, Exception):
+            logger.error(f"Error producing batch item: {outcome}")
+            failed.append(item)
+        elif outcome is not None:
+            symbol, symbol_records = outcome
+            symbols.append(symbol)
+            records.extend(symbol_records)
+
+    if not symbols and not failed:
+        return None
+    return symbols, records, failed
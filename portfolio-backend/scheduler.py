@@ -1,34 +1,30 @@
 #!/usr/bin/env python3
 """
 Simple scheduler script for running price updates at regular intervals.
-This can be used with cron jobs (Linux/Mac) or Windows Task Scheduler.
+By default it runs one update and exits, for cron jobs (Linux/Mac) or Windows Task Scheduler.
+With --daemon it stays up and runs the update on Config.SCHEDULE_CRON itself.
 """
 
 import asyncio
 import logging
+import sys
 from datetime import datetime
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.cron import CronTrigger
 from incremental_price_updater import IncrementalPriceUpdater
 from config import Config
+from db import close_all_pools
+from logging_setup import setup_logging
 
-# Configure logging
-logging.basicConfig(
-    level=getattr(logging, Config.LOG_LEVEL),
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(Config.LOG_FILE),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
-async def run_scheduled_update():
+async def run_scheduled_update(updater: IncrementalPriceUpdater, refresh: bool = False):
     """Run the scheduled update"""
     try:
         logger.info("Starting scheduled price update")
         start_time = datetime.now()
         
-        updater = IncrementalPriceUpdater()
-        await updater.run_daily_update()
+        await updater.run_daily_update(refresh)
         
         end_time = datetime.now()
         duration = end_time - start_time
@@ -39,13 +35,58 @@ async def run_scheduled_update():
         logger.error(f"Error in scheduled update: {e}")
         raise
 
+async def run_once(refresh: bool = False):
+    """Run a single update and release the connections, for external schedulers"""
+    updater = IncrementalPriceUpdater()
+    try:
+        await run_scheduled_update(updater, refresh)
+    finally:
+        await updater.yahoo.aclose()
+        await close_all_pools()
+
+async def run_daemon(refresh: bool = False):
+    """Run the update on Config.SCHEDULE_CRON until stopped, reusing one pool and HTTP client"""
+    updater = IncrementalPriceUpdater()
+    try:
+        await updater.init_pool()
+        
+        scheduler = AsyncIOScheduler()
+        scheduler.add_job(
+            run_scheduled_update,
+            CronTrigger.from_crontab(Config.SCHEDULE_CRON),
+            args=[updater, refresh],
+            # Never overlap runs, and run a missed one only once
+            max_instances=1,
+            coalesce=True,
+            misfire_grace_time=Config.SCHEDULE_MISFIRE_GRACE
+        )
+        scheduler.start()
+        logger.info(f"Scheduler started with schedule '{Config.SCHEDULE_CRON}'")
+        
+        try:
+            await asyncio.Event().wait()
+        finally:
+            scheduler.shutdown(wait=False)
+    finally:
+        await updater.yahoo.aclose()
+        await close_all_pools()
+
 def main():
     """Main function for the scheduler"""
+    listener = setup_logging()
+    refresh = '--refresh' in sys.argv
     try:
-        asyncio.run(run_scheduled_update())
+        if '--daemon' in sys.argv:
+            asyncio.run(run_daemon(refresh))
+        else:
+            asyncio.run(run_once(refresh))
+    except KeyboardInterrupt:
+        logger.info("Scheduler stopped")
     except Exception as e:
         logger.error(f"Fatal error in scheduler: {e}")
         exit(1)
+    finally:
+        listener.stop()
 
 if __name__ == "__main__":
     main()
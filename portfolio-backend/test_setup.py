@@ -9,6 +9,7 @@ import logging
 from dotenv import load_dotenv
 from incremental_price_updater import IncrementalPriceUpdater
 from config import Config
+from db import close_all_pools
 
 # Load environment variables
 load_dotenv()
@@ -30,9 +31,10 @@ async def test_setup():
         updater = IncrementalPriceUpdater()
         
         # Test connection
-        conn = await updater.get_db_connection()
+        await updater.init_pool()
+        async with updater.pool.acquire() as conn:
+            await conn.fetchval("SELECT 1")
         logger.info("✅ Database connection successful")
-        await conn.close()
         
         # Test symbol mappings fetch
         logger.info("Testing symbol mappings fetch...")
@@ -60,6 +62,9 @@ async def test_setup():
     except Exception as e:
         logger.error(f"❌ Setup test failed: {e}")
         raise
+    finally:
+        await updater.yahoo.aclose()
+        await close_all_pools()
 
 def main():
     """Main function"""
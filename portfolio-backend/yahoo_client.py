@@ -0,0 +1,257 @@
+import asyncio
+import logging
+import time
+from datetime import date, datetime, time as dt_time, timedelta, timezone
+from typing import Dict, Optional
+import httpx
+import numpy as np
+import pandas as pd
+from tenacity import before_sleep_log, retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+CHART_URL = 'https://query1.finance.yahoo.com/v8/finance/chart/{symbol}'
+
+# Yahoo rejects requests without a browser-like user agent
+HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36'}
+
+def to_epoch(day: date) -> int:
+    """Convert a date to the UTC epoch timestamp of its midnight"""
+    return int(datetime.combine(day, dt_time(), tzinfo=timezone.utc).timestamp())
+
+PRICE_FIELDS = ['open_price', 'high_price', 'low_price', 'close_price']
+
+# Decimals of the DECIMAL(10,4) price columns
+PRICE_DECIMALS = 4
+
+def downcast_prices(hist_data: pd.DataFrame) -> pd.DataFrame:
+    """Shrink OHLCV columns to the smallest dtypes that still hold them at database precision"""
+    for column in PRICE_FIELDS:
+        prices = hist_data[column]
+        downcast = pd.to_numeric(prices, downcast='float')
+        # float32 keeps ~7 significant digits, large prices need float64 to keep 4 decimals;
+        # only downcast when every price still rounds to the same stored value
+        if np.array_equal(downcast.astype('float64').round(PRICE_DECIMALS), prices.round(PRICE_DECIMALS), equal_nan=True):
+            hist_data[column] = downcast
+    
+    # Only takes effect when no volume is missing, NaN keeps the column float
+    hist_data['volume'] = pd.to_numeric(hist_data['volume'], downcast='integer')
+    return hist_data
+
+class AdaptiveLimiter:
+    """Concurrency limit that grows by one on healthy responses and is cut
+    multiplicatively on throttling (additive increase, multiplicative decrease)"""
+
+    def __init__(self, initial: int, maximum: int):
+        self.limit = initial
+        self.maximum = maximum
+        self.in_flight = 0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def increase(self):
+        self.limit = min(self.maximum, self.limit + 1)
+
+    def decrease(self):
+        self.limit = max(1, int(self.limit * Config.BACKOFF_FACTOR))
+
+def retry_after(response: httpx.Response) -> float:
+    """Seconds to wait before retrying a throttled response"""
+    try:
+        return float(response.headers.get('Retry-After', Config.RETRY_AFTER_DEFAULT))
+    except ValueError:
+        # HTTP-date form, not worth parsing for a short back-off
+        return Config.RETRY_AFTER_DEFAULT
+
+def is_retryable(exc: BaseException) -> bool:
+    """Transient failures worth retrying: network errors, throttling and server errors"""
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code == 429 or exc.response.status_code >= 500
+    return isinstance(exc, httpx.TransportError)
+
+_exponential_jitter = wait_random_exponential(multiplier=1, max=Config.RETRY_MAX_WAIT)
+
+def wait_before_retry(retry_state) -> float:
+    """Exponential back-off with full jitter, never shorter than a 429's Retry-After"""
+    delay = _exponential_jitter(retry_state)
+    exc = retry_state.outcome.exception()
+    if isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code == 429:
+        delay = max(delay, retry_after(exc.response))
+    return delay
+
+class YahooChartClient:
+    """Async client for Yahoo Finance's chart endpoint, sharing one HTTP/2 connection pool"""
+
+    def __init__(self):
+        self.client = httpx.AsyncClient(
+            http2=True,
+            timeout=Config.HTTP_TIMEOUT,
+            limits=httpx.Limits(max_keepalive_connections=Config.HTTP_MAX_KEEPALIVE),
+            headers=HEADERS
+        )
+        self.limiter = AdaptiveLimiter(Config.CONCURRENCY, Config.MAX_CONCURRENCY)
+        # Sliding rate-limit window, as reported by the X-RateLimit-* headers
+        self._remaining: Optional[int] = None
+        self._reset_at = 0.0
+
+    async def aclose(self):
+        """Close the underlying HTTP connections"""
+        await self.client.aclose()
+
+    def _update_rate_window(self, response: httpx.Response):
+        """Track the remaining requests of the current rate-limit window"""
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        reset = response.headers.get('X-RateLimit-Reset')
+        if remaining is None:
+            return
+        try:
+            remaining = int(remaining)
+            reset = float(reset) if reset is not None else None
+        except ValueError:
+            # Malformed headers, keep pacing on the previous window
+            logger.debug(f"Ignoring malformed rate-limit headers: {remaining!r}, {reset!r}")
+            return
+        self._remaining = remaining
+        if reset is not None:
+            # Either seconds until the reset or an absolute epoch timestamp
+            self._reset_at = reset if reset > time.time() else time.time() + reset
+
+    async def get(self, url: str, params: Dict) -> httpx.Response:
+        """GET paced by the rate-limit headers and the adaptive limiter instead of a fixed delay"""
+        # Only pause when the window is nearly used up
+        if self._remaining is not None and self._remaining < Config.RATE_LIMIT_MIN_REMAINING:
+            wait = self._reset_at - time.time()
+            if wait > 0:
+                logger.info(f"Rate limit window nearly exhausted, waiting {wait:.1f}s")
+                await asyncio.sleep(wait)
+            self._remaining = None
+
+        async with self.limiter:
+            response = await self.client.get(url, params=params)
+        self._update_rate_window(response)
+
+        if response.status_code == 429:
+            self.limiter.decrease()
+            logger.warning(f"Throttled by Yahoo, request limit lowered to {self.limiter.limit}")
+        elif response.status_code < 500:
+            if self._remaining is None or self._remaining >= Config.RATE_LIMIT_MIN_REMAINING:
+                self.limiter.increase()
+        return response
+
+    @retry(
+        retry=retry_if_exception(is_retryable),
+        wait=wait_before_retry,
+        stop=stop_after_attempt(Config.MAX_RETRIES),
+        before_sleep=before_sleep_log(logger, logging.WARNING),
+        reraise=True
+    )
+    async def fetch_chart(self, symbol: str, start_date: date, end_date: date) -> Optional[Dict]:
+        """Fetch the raw daily chart result for a symbol, covering at least start_date up to end_date"""
+        # Bars are stamped at the exchange open, which is before 00:00 UTC east of it (ASX, NZX),
+        # so pad the UTC range by a day and let the callers filter on the local date
+        params = {
+            'period1': to_epoch(start_date - timedelta(days=1)),
+            'period2': to_epoch(end_date + timedelta(days=1)),
+            'interval': '1d',
+            'includeAdjustedClose': 'true'
+        }
+        response = await self.get(CHART_URL.format(symbol=symbol), params)
+
+        # Unknown symbols come back as 404 with an error payload
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+
+        result = response.json()['chart']['result']
+        if not result or not result[0].get('timestamp'):
+            return None
+        return result[0]
+
+    async def fetch_history(self, symbol: str, start_date: date, end_date: date) -> Optional[pd.DataFrame]:
+        """Fetch adjusted daily prices for a symbol from start_date up to, not including, end_date,
+        with columns matching the price_history table"""
+        chart = await self.fetch_chart(symbol, start_date, end_date)
+        if chart is None:
+            return None
+
+        # Missing values are null in the JSON arrays and become NaN here
+        quote = chart['indicators']['quote'][0]
+        opens = np.array(quote['open'], dtype='float64')
+        highs = np.array(quote['high'], dtype='float64')
+        lows = np.array(quote['low'], dtype='float64')
+        closes = np.array(quote['close'], dtype='float64')
+        volumes = np.array(quote['volume'], dtype='float64')
+
+        # Adjust OHLC for splits and dividends, as yfinance does with auto_adjust=True
+        adjclose = chart['indicators'].get('adjclose')
+        if adjclose:
+            adj_closes = np.array(adjclose[0]['adjclose'], dtype='float64')
+            ratio = adj_closes / closes
+            opens, highs, lows, closes = opens * ratio, highs * ratio, lows * ratio, adj_closes
+
+        # Timestamps are UTC, shift them to the exchange's local day
+        offset = chart['meta'].get('gmtoffset', 0)
+        dates = pd.to_datetime(np.array(chart['timestamp']) + offset, unit='s').date
+
+        # Drop the bars of the padding days
+        in_range = (dates >= start_date) & (dates < end_date)
+
+        hist_data = pd.DataFrame({
+            'date': dates[in_range],
+            'open_price': opens[in_range],
+            'high_price': highs[in_range],
+            'low_price': lows[in_range],
+            'close_price': closes[in_range],
+            'volume': volumes[in_range],
+            'yahoo_symbol': symbol
+        })
+        hist_data.dropna(subset=PRICE_FIELDS, how='all', inplace=True)
+
+        if hist_data.empty:
+            return None
+        return downcast_prices(hist_data)
+
+    async def fetch_daily_row(self, symbol: str, start_date: date, end_date: date) -> Optional[tuple]:
+        """Fetch the latest adjusted daily bar of a symbol before end_date as a price_history record,
+        (yahoo_symbol, date, open, high, low, close, volume), without building a DataFrame"""
+        chart = await self.fetch_chart(symbol, start_date, end_date)
+        if chart is None:
+            return None
+
+        quote = chart['indicators']['quote'][0]
+        adjclose = chart['indicators'].get('adjclose')
+        adj_closes = adjclose[0]['adjclose'] if adjclose else quote['close']
+        offset = chart['meta'].get('gmtoffset', 0)
+
+        # Walk back from the latest bar, skipping days Yahoo returned without prices
+        for i in reversed(range(len(chart['timestamp']))):
+            # Timestamps are UTC, shift them to the exchange's local day and skip the padding days
+            day = datetime.fromtimestamp(chart['timestamp'][i] + offset, tz=timezone.utc).date()
+            if day >= end_date:
+                continue
+            if day < start_date:
+                break
+
+            prices = [quote[field][i] for field in ('open', 'high', 'low', 'close')]
+            if all(price is None for price in prices):
+                continue
+
+            # Adjust OHLC for splits and dividends, like fetch_history
+            close, adj_close = prices[3], adj_closes[i]
+            ratio = adj_close / close if close and adj_close is not None else 1.0
+            open_price, high, low = (float(p) * ratio if p is not None else None for p in prices[:3])
+            close = float(adj_close) if adj_close is not None else close
+            volume = quote['volume'][i]
+            return (symbol, day, open_price, high, low, close, int(volume) if volume is not None else None)
+
+        return None